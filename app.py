@@ -1,16 +1,119 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, render_template, jsonify, request
+from flask.json.provider import DefaultJSONProvider
+from flask_compress import Compress
 import os
-import json
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
+try:
+    import brotlicffi as brotli
+except ImportError:
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
 import re
-from typing import Optional, Callable, Dict, List
+import time
+import threading
+import functools
+from collections import OrderedDict
+import gzip
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Callable, Dict, Iterable, Iterator, List
 
 load_dotenv()
 
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson, so any remaining jsonify() calls encode in C."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        if kwargs.get("sort_keys"):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+# GeoJSON payloads compress well; negotiate br/gzip with the client
+app.config.update(
+    COMPRESS_MIMETYPES=['application/json', 'application/geo+json', 'text/html', 'text/css', 'application/javascript'],
+    COMPRESS_ALGORITHM=['br', 'gzip'],
+    COMPRESS_LEVEL=4,
+    COMPRESS_BR_LEVEL=4,
+)
+Compress(app)
 
 ONEMAP_BASE = "https://www.onemap.gov.sg"
+# Master Plan editions served by OneMap's getAllPlanningarea; other ?year= values are rejected
+# before they reach the upstream call or the response cache.
+PLANNING_YEARS = frozenset({"1998", "2008", "2014", "2019"})
+
+
+def _pooled_session() -> requests.Session:
+    """Session with a keep-alive connection pool so upstream calls reuse TLS connections."""
+    s = requests.Session()
+    retry = Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504], allowed_methods=["GET"])
+    s.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retry))
+    return s
+
+
+# One pool for OneMap, one for the Azure OpenAI endpoint
+_onemap = _pooled_session()
+_azure = _pooled_session()
+
+# ---------------------- Upstream response cache ----------------------
+# OneMap layers change at most daily, so repeated chat turns and map refreshes
+# can share one upstream fetch for a few minutes.
+UPSTREAM_CACHE_TTL = 600
+# Upper bound on cached entries across all memoized functions; least recently used go first
+UPSTREAM_CACHE_MAX_ENTRIES = 32
+_ttl_store: "OrderedDict[tuple, tuple]" = OrderedDict()
+_ttl_lock = threading.Lock()
+
+
+def _ttl_cache(ttl: int):
+    """Memoize a function's result for `ttl` seconds, keyed by name and arguments.
+    Empty results (failed or unauthenticated fetches) are not cached so they are retried.
+    Expired entries are purged on insert and the store is capped at UPSTREAM_CACHE_MAX_ENTRIES (LRU).
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            key = (fn.__name__, args, tuple(sorted(kwargs.items())))
+            now = time.monotonic()
+            with _ttl_lock:
+                hit = _ttl_store.get(key)
+                if hit and hit[0] > now:
+                    _ttl_store.move_to_end(key)
+                    return hit[1]
+            value = fn(*args, **kwargs)
+            if value:
+                with _ttl_lock:
+                    for k in [k for k, (expiry, _) in _ttl_store.items() if expiry <= now]:
+                        del _ttl_store[k]
+                    _ttl_store[key] = (now + ttl, value)
+                    _ttl_store.move_to_end(key)
+                    while len(_ttl_store) > UPSTREAM_CACHE_MAX_ENTRIES:
+                        _ttl_store.popitem(last=False)
+            return value
+        return wrapper
+    return decorator
+
+
+def _ojson(obj) -> Response:
+    """Serialize obj with orjson straight into a JSON Response."""
+    return Response(orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS), mimetype='application/json')
 
 
 def _get_token():
@@ -24,30 +127,54 @@ def _get_token():
 # Each layer entry provides:
 # - title: display name
 # - synonyms: list of keywords to detect in user queries
-# - context_builder: callable(max_items:int)->str that returns a brief, parseable context
+# - context_builder: callable(max_items:int)->str that returns a brief, parseable context;
+#   raises when the layer's data is unavailable so callers skip it rather than report zero items
 # - total_regex: regex to extract an integer total from the first summary line of the context
+# - total_re: total_regex precompiled once, used by the request handlers
 
 def _planning_context_builder(max_items: int = 100) -> str:
     return _build_planning_context(max_items=max_items, year="2019")
 
+# Built once at import; handlers share this dict rather than rebuilding it per request.
+_LAYER_REGISTRY: Dict[str, Dict[str, object]] = {
+    "dengue": {
+        "title": "Dengue Hotspots",
+        "synonyms": ["dengue", "hotspot", "cluster", "clusters"],
+        "context_builder": lambda max_items=50: _build_dengue_context(max_items=max_items),
+        "total_regex": r":\s*(\d+)\s*unique",
+    },
+    "planning": {
+        "title": "Planning Areas (2019)",
+        "synonyms": ["planning area", "planning", "boundary", "boundaries"],
+        "context_builder": lambda max_items=100: _planning_context_builder(max_items=max_items),
+        "total_regex": r":\s*(\d+)\s*total",
+    },
+    # For myself to take note
+    # To add a new layer in the future, register here with
+    # "layer_key": {"title": "...", "synonyms": ["..."], "context_builder": callable, "total_regex": r"..."}
+}
+for _meta in _LAYER_REGISTRY.values():
+    _meta["total_re"] = re.compile(_meta["total_regex"])
+
+
 def get_layer_registry() -> Dict[str, Dict[str, object]]:
-    return {
-        "dengue": {
-            "title": "Dengue Hotspots",
-            "synonyms": ["dengue", "hotspot", "cluster", "clusters"],
-            "context_builder": lambda max_items=50: _build_dengue_context(max_items=max_items),
-            "total_regex": r":\s*(\d+)\s*unique",
-        },
-        "planning": {
-            "title": "Planning Areas (2019)",
-            "synonyms": ["planning area", "planning", "boundary", "boundaries"],
-            "context_builder": lambda max_items=100: _planning_context_builder(max_items=max_items),
-            "total_regex": r":\s*(\d+)\s*total",
-        },
-        # For myself to take note
-        # To add a new layer in the future, register here with
-        # "layer_key": {"title": "...", "synonyms": ["..."], "context_builder": callable, "total_regex": r"..."}
-    }
+    return _LAYER_REGISTRY
+
+
+# Layer key plus its synonyms, precomputed for substring matching on the request path
+_SYNS: Dict[str, tuple] = {
+    k: tuple(dict.fromkeys([k] + list(m.get("synonyms") or [])))
+    for k, m in _LAYER_REGISTRY.items()
+}
+
+_LAYER_NAMES = frozenset(_LAYER_REGISTRY)
+
+_CLEAR_RE = re.compile(r"\b(clear|reset|remove\s+all)\b")
+_LIST_RE = re.compile(r"\b(list|show)\b")
+_SUMMARY_RE = re.compile(r"\b(summarize|summary)\b")
+# Whole-message no-op turns answered without touching upstream data or Azure
+_GREETING_RE = re.compile(r"^\s*(hi|hello|hey|thanks|thank you|help)\b[!. ]*$", re.I)
+_CLEAR_ONLY_RE = re.compile(r"^\s*(clear|reset|remove\s+all)(\s+(the\s+)?(map|all|layers|overlays))?[!. ]*$", re.I)
 
 
 @app.route('/')
@@ -55,194 +182,230 @@ def index():
     return render_template('index.html')
 
 
-@app.route('/api/planning-areas')
-def planning_areas():
+def _etagged_collection(features: Iterable[dict]) -> tuple:
+    """Encode a FeatureCollection feature-by-feature and pair it with a content hash usable as an ETag.
+    Each Feature dict is serialized as soon as it is produced, so the full dict tree is never held
+    alongside the encoded body.
+    """
+    body = b''.join((
+        b'{"type":"FeatureCollection","features":[',
+        b','.join(orjson.dumps(f, option=orjson.OPT_NON_STR_KEYS) for f in features),
+        b']}',
+    ))
+    return hashlib.blake2b(body, digest_size=16).hexdigest(), body
+
+
+# Pre-compressed variants of the cached GeoJSON bodies, keyed by (etag, algorithm)
+_ENCODED_MAX_ENTRIES = 8
+_encoded_bodies: "OrderedDict[tuple, bytes]" = OrderedDict()
+_encoded_lock = threading.Lock()
+
+
+def _encoded_body(etag: str, body: bytes, algorithm: str) -> bytes:
+    """Compress body once per (etag, algorithm) and keep the last few results in memory."""
+    key = (etag, algorithm)
+    with _encoded_lock:
+        hit = _encoded_bodies.get(key)
+        if hit is not None:
+            _encoded_bodies.move_to_end(key)
+            return hit
+    if algorithm == 'br':
+        encoded = brotli.compress(body, quality=app.config['COMPRESS_BR_LEVEL'])
+    else:
+        encoded = gzip.compress(body, compresslevel=app.config['COMPRESS_LEVEL'])
+    with _encoded_lock:
+        _encoded_bodies[key] = encoded
+        while len(_encoded_bodies) > _ENCODED_MAX_ENTRIES:
+            _encoded_bodies.popitem(last=False)
+    return encoded
+
+
+def _cacheable_json(etag: str, body: bytes) -> Response:
+    """JSON response with ETag/Cache-Control; answers 304 when If-None-Match matches.
+    The body is compressed here (cached per etag) rather than by flask-compress, which skips
+    responses that already carry Content-Encoding. Encoded variants use flask-compress's
+    "<etag>:<algorithm>" tag format, and the 304 check runs before any compression.
+    """
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    algorithm = request.accept_encodings.best_match(offered)
+    tag = f"{etag}:{algorithm}" if algorithm else etag
+    # If-None-Match uses weak comparison, so a W/ tag from a proxy still revalidates
+    if request.if_none_match.contains_weak(tag):
+        resp = Response(status=304)
+    else:
+        payload = _encoded_body(etag, body, algorithm) if algorithm else body
+        resp = Response(payload, mimetype='application/json')
+        if algorithm:
+            resp.headers['Content-Encoding'] = algorithm
+    resp.vary.add('Accept-Encoding')
+    resp.set_etag(tag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = UPSTREAM_CACHE_TTL
+    return resp
+
+
+def _fetch_onemap_json(path: str, params: Optional[dict] = None):
+    """GET a OneMap API path with the configured token; returns decoded JSON or None if no token."""
     token = _get_token()
     if not token:
-        return jsonify({"error": "Missing ONEMAP_TOKEN environment variable."}), 400
-    year = request.args.get('year')
-    url = f"{ONEMAP_BASE}/api/public/popapi/getAllPlanningarea"
-    params = {}
-    if year:
-        params['year'] = year
-    try:
-        r = requests.get(url, headers={'Authorization': token}, params=params, timeout=15)
-        r.raise_for_status()
-        data = r.json()
-        features = []
-        for item in data.get('SearchResults', []):
-            name = item.get('pln_area_n')
-            geojson_str = item.get('geojson')
-            if not geojson_str:
-                continue
-            try:
-                geom = json.loads(geojson_str)
-            except Exception:
+        return None
+    r = _onemap.get(f"{ONEMAP_BASE}{path}", headers={'Authorization': token}, params=params or {}, timeout=15)
+    r.raise_for_status()
+    return orjson.loads(r.content)
+
+
+# Raw upstream payloads are cached once and shared by the GeoJSON endpoints and the chat helpers.
+# They raise on upstream failure (so errors are never cached) and must be treated as read-only.
+@_ttl_cache(UPSTREAM_CACHE_TTL)
+def _planning_data(year: Optional[str]):
+    return _fetch_onemap_json("/api/public/popapi/getAllPlanningarea", {"year": year} if year else {})
+
+
+@_ttl_cache(UPSTREAM_CACHE_TTL)
+def _dengue_data():
+    return _fetch_onemap_json("/api/public/themesvc/retrieveTheme", {"queryName": "dengue_cluster"})
+
+
+def _iter_planning_features(data: Optional[dict]) -> Iterator[dict]:
+    """Yield GeoJSON Features from a getAllPlanningarea payload."""
+    for item in (data or {}).get('SearchResults', []):
+        name = item.get('pln_area_n')
+        geojson_str = item.get('geojson')
+        if not geojson_str:
+            continue
+        try:
+            geom = orjson.loads(geojson_str)
+        except Exception:
+            continue
+        yield {
+            "type": "Feature",
+            "properties": {"name": name},
+            "geometry": geom
+        }
+
+
+def _iter_dengue_features(data: Optional[dict]) -> Iterator[dict]:
+    """Yield GeoJSON Features from a dengue_cluster theme payload without mutating it."""
+    for item in (data or {}).get('SrchResults', []):
+        if 'GeoJSON' in item:
+            gj = item['GeoJSON']
+            geom = gj.get('geometry') if isinstance(gj, dict) else None
+            if not geom:
                 continue
-            features.append({
+            coords = geom.get('coordinates')
+            if isinstance(coords, str):
+                try:
+                    coords = orjson.loads(coords)
+                except Exception:
+                    continue
+            # Some polygons arrive without the ring-level wrapper; check each one, as a batch can mix both
+            if geom.get('type') == 'Polygon' and coords and isinstance(coords, list) and isinstance(coords[0][0], (int, float)):
+                coords = [coords]
+            if coords is not geom.get('coordinates'):
+                geom = {**geom, 'coordinates': coords}
+            properties = {k: v for k, v in item.items() if k != 'GeoJSON'}
+            yield {
                 "type": "Feature",
-                "properties": {"name": name},
+                "properties": properties,
                 "geometry": geom
-            })
-        return jsonify({"type": "FeatureCollection", "features": features})
-    except requests.RequestException as e:
-        return jsonify({"error": str(e)}), 502
+            }
 
 
-@app.route('/api/dengue-clusters')
-def dengue_clusters():
+@_ttl_cache(UPSTREAM_CACHE_TTL)
+def _planning_areas_body(year: Optional[str]) -> tuple:
+    """(etag, body) for the planning areas FeatureCollection; raises on upstream failure."""
+    return _etagged_collection(_iter_planning_features(_planning_data(year)))
+
+
+@app.route('/api/planning-areas')
+def planning_areas():
     token = _get_token()
     if not token:
         return jsonify({"error": "Missing ONEMAP_TOKEN environment variable."}), 400
-    url = f"{ONEMAP_BASE}/api/public/themesvc/retrieveTheme"
-    params = {"queryName": "dengue_cluster"}
+    year = request.args.get('year') or None
+    if year is not None and year not in PLANNING_YEARS:
+        return jsonify({"error": f"Unsupported year; expected one of {', '.join(sorted(PLANNING_YEARS))}."}), 400
     try:
-        r = requests.get(url, headers={'Authorization': token}, params=params, timeout=15)
-        r.raise_for_status()
-        data = r.json()
-        features = []
-        for item in data.get('SrchResults', []):
-            if 'GeoJSON' in item:
-                gj = item['GeoJSON']
-                geom = gj.get('geometry') if isinstance(gj, dict) else None
-                if not geom:
-                    continue
-                coords = geom.get('coordinates')
-                if isinstance(coords, str):
-                    try:
-                        coords = json.loads(coords)
-                    except Exception:
-                        continue
-                    geom['coordinates'] = coords
-                if geom.get('type') == 'Polygon' and coords and isinstance(coords, list) and coords and isinstance(coords[0][0], (int, float)):
-                    geom['coordinates'] = [coords]
-                properties = {k: v for k, v in item.items() if k != 'GeoJSON'}
-                features.append({
-                    "type": "Feature",
-                    "properties": properties,
-                    "geometry": geom
-                })
-        return jsonify({"type": "FeatureCollection", "features": features})
-    except requests.RequestException as e:
+        etag, body = _planning_areas_body(year)
+        return _cacheable_json(etag, body)
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
         return jsonify({"error": str(e)}), 502
 
 
-def _get_planning_features(year: Optional[str] = "2019") -> list:
-    """Internal helper to fetch planning area features (GeoJSON Features)."""
-    token = _get_token()
-    if not token:
-        return []
-    url = f"{ONEMAP_BASE}/api/public/popapi/getAllPlanningarea"
-    params = {"year": year} if year else {}
-    try:
-        r = requests.get(url, headers={'Authorization': token}, params=params, timeout=15)
-        r.raise_for_status()
-        data = r.json()
-        features = []
-        for item in data.get('SearchResults', []):
-            name = item.get('pln_area_n')
-            geojson_str = item.get('geojson')
-            if not geojson_str:
-                continue
-            try:
-                geom = json.loads(geojson_str)
-            except Exception:
-                continue
-            features.append({
-                "type": "Feature",
-                "properties": {"name": name},
-                "geometry": geom
-            })
-        return features
-    except Exception:
-        return []
+@_ttl_cache(UPSTREAM_CACHE_TTL)
+def _dengue_clusters_body() -> tuple:
+    """(etag, body) for the dengue clusters FeatureCollection; raises on upstream failure."""
+    return _etagged_collection(_iter_dengue_features(_dengue_data()))
 
 
-def _get_dengue_features() -> list:
-    """Internal helper to fetch dengue cluster features (GeoJSON Features)."""
+@app.route('/api/dengue-clusters')
+def dengue_clusters():
     token = _get_token()
     if not token:
-        return []
-    url = f"{ONEMAP_BASE}/api/public/themesvc/retrieveTheme"
-    params = {"queryName": "dengue_cluster"}
+        return jsonify({"error": "Missing ONEMAP_TOKEN environment variable."}), 400
     try:
-        r = requests.get(url, headers={'Authorization': token}, params=params, timeout=15)
-        r.raise_for_status()
-        data = r.json()
-        features = []
-        for item in data.get('SrchResults', []):
-            if 'GeoJSON' in item:
-                gj = item['GeoJSON']
-                geom = gj.get('geometry') if isinstance(gj, dict) else None
-                if not geom:
-                    continue
-                coords = geom.get('coordinates')
-                if isinstance(coords, str):
-                    try:
-                        coords = json.loads(coords)
-                    except Exception:
-                        continue
-                    geom['coordinates'] = coords
-                if geom.get('type') == 'Polygon' and coords and isinstance(coords, list) and coords and isinstance(coords[0][0], (int, float)):
-                    geom['coordinates'] = [coords]
-                properties = {k: v for k, v in item.items() if k != 'GeoJSON'}
-                features.append({
-                    "type": "Feature",
-                    "properties": properties,
-                    "geometry": geom
-                })
-        return features
-    except Exception:
-        return []
+        etag, body = _dengue_clusters_body()
+        return _cacheable_json(etag, body)
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
+        return jsonify({"error": str(e)}), 502
 
 
-def _build_dengue_context(max_items: int = 50) -> str:
-    """Build a compact text context from dengue cluster features for LLM grounding."""
-    feats = _get_dengue_features()
+def _get_planning_names(year: Optional[str] = "2019") -> list:
+    """Planning area names only, read straight from the upstream rows without decoding geometry.
+    Raises when the upstream fetch fails or no token is configured.
+    """
+    data = _planning_data(year)
+    if data is None:
+        raise RuntimeError("Missing ONEMAP_TOKEN environment variable.")
+    return [
+        str(item['pln_area_n'])
+        for item in data.get('SearchResults', [])
+        if item.get('geojson') and item.get('pln_area_n')
+    ]
+
+
+def _get_dengue_names() -> list:
+    """Dengue cluster names only, read straight from the upstream rows without building features.
+    Raises when the upstream fetch fails or no token is configured.
+    """
+    data = _dengue_data()
+    if data is None:
+        raise RuntimeError("Missing ONEMAP_TOKEN environment variable.")
     names = []
-    for f in feats:
-        p = f.get('properties') or {}
-        name = p.get('DESCRIPTION') or p.get('NAME') or p.get('Description') or p.get('Name')
+    for item in data.get('SrchResults', []):
+        gj = item.get('GeoJSON')
+        if not (isinstance(gj, dict) and gj.get('geometry')):
+            continue
+        name = item.get('DESCRIPTION') or item.get('NAME') or item.get('Description') or item.get('Name')
         if name:
             names.append(str(name))
+    return names
+
+
+def _build_dengue_context(max_items: int = 50) -> str:
+    """Build a compact text context from dengue cluster names for LLM grounding."""
     # de-dup while preserving order
-    seen = set()
-    unique = []
-    for n in names:
-        if n not in seen:
-            unique.append(n)
-            seen.add(n)
+    unique = list(dict.fromkeys(_get_dengue_names()))
     total = len(unique)
     sample = unique[:max_items]
-    lines = "\n".join(f"- {n}" for n in sample)
+    lines = "- " + "\n- ".join(sample) if sample else ""
     return f"Latest dengue clusters: {total} unique clusters.\nList (first {len(sample)}):\n{lines}"
 
 
 def _build_planning_context(max_items: int = 100, year: Optional[str] = "2019") -> str:
-    """Build a compact text context from planning area features for LLM grounding."""
-    feats = _get_planning_features(year=year)
-    names = []
-    for f in feats:
-        p = f.get('properties') or {}
-        name = p.get('name')
-        if name:
-            names.append(str(name))
-    seen = set()
-    unique = []
-    for n in names:
-        if n not in seen:
-            unique.append(n)
-            seen.add(n)
+    """Build a compact text context from planning area names for LLM grounding."""
+    unique = list(dict.fromkeys(_get_planning_names(year=year)))
     total = len(unique)
     sample = unique[:max_items]
-    lines = "\n".join(f"- {n}" for n in sample)
+    lines = "- " + "\n- ".join(sample) if sample else ""
     return f"Planning areas (year={year}): {total} total.\nList (first {len(sample)}):\n{lines}"
 
 
+@_ttl_cache(UPSTREAM_CACHE_TTL)
 def _get_all_theme_infos(token: str):
     try:
         url = f"{ONEMAP_BASE}/api/public/themesvc/getAllThemesInfo"
-        r = requests.get(url, headers={'Authorization': token}, timeout=15)
+        r = _onemap.get(url, headers={'Authorization': token}, timeout=15)
         r.raise_for_status()
         return r.json()
     except Exception:
@@ -255,46 +418,115 @@ def themes_info():
     if not token:
         return jsonify({"error": "Missing ONEMAP_TOKEN environment variable."}), 400
     info = _get_all_theme_infos(token)
-    return jsonify(info if info is not None else {"error": "Failed to fetch."})
+    return _ojson(info if info is not None else {"error": "Failed to fetch."})
 
 # ---------------------- Chatbot API ----------------------
 
+# Shared pool so per-layer context builders (each an upstream fetch) run concurrently
+_pool = ThreadPoolExecutor(max_workers=8)
+CONTEXT_BUILD_TIMEOUT = 15
+
+
+def _build_layer_contexts(registry: Dict[str, Dict[str, object]], max_items: int) -> Dict[str, str]:
+    """Run every layer's context_builder in parallel; returns {layer_key: context} in registry order.
+    Layers whose builder fails or times out are skipped.
+    """
+    futures = {
+        key: _pool.submit(meta["context_builder"], max_items)
+        for key, meta in registry.items()
+        if callable(meta.get("context_builder"))
+    }
+    contexts: Dict[str, str] = {}
+    for key, fut in futures.items():
+        try:
+            contexts[key] = fut.result(timeout=CONTEXT_BUILD_TIMEOUT)
+        except Exception:
+            continue
+    return contexts
+
+
+# ---------------------- Background context refresh ----------------------
+# When CONTEXT_REFRESH_ENABLED is set, a daemon thread keeps the chat grounding contexts warm
+# so /api/chat reads them from memory instead of fetching upstream on the request path.
+CHAT_CONTEXT_ITEMS = 100
+CONTEXT_REFRESH_INTERVAL = int(os.environ.get("CONTEXT_REFRESH_INTERVAL", "300"))
+_cached_contexts: Dict[str, str] = {}
+_cached_contexts_lock = threading.Lock()
+
+
+def _refresh_contexts_loop() -> None:
+    global _cached_contexts
+    while True:
+        fresh = _build_layer_contexts(_LAYER_REGISTRY, CHAT_CONTEXT_ITEMS)
+        # Layers whose fetch failed are absent from `fresh`; keep their last good context
+        with _cached_contexts_lock:
+            _cached_contexts = {**_cached_contexts, **fresh}
+        # Retry sooner while any layer is failing
+        time.sleep(CONTEXT_REFRESH_INTERVAL if fresh.keys() >= _LAYER_REGISTRY.keys() else 30)
+
+
+def _chat_contexts(registry: Dict[str, Dict[str, object]]) -> Dict[str, str]:
+    """Grounding contexts for the given layers: served from the refresher when warm, built on demand otherwise."""
+    with _cached_contexts_lock:
+        cached = _cached_contexts
+    contexts = {k: cached[k] for k in registry if k in cached}
+    missing = {k: meta for k, meta in registry.items() if k not in contexts}
+    if missing:
+        contexts.update(_build_layer_contexts(missing, CHAT_CONTEXT_ITEMS))
+    return {k: contexts[k] for k in registry if k in contexts}
+
+
 def _classify_intents(message: str):
     """Very small rule-based intent extractor for map actions."""
     text = message.lower().strip()
     intents = []
 
     # Clear/reset map
-    if re.search(r"\b(clear|reset|remove\s+all)\b", text):
+    if _CLEAR_RE.search(text):
         intents.append({"type": "clear_all"})
 
     wants_hide = any(w in text for w in ["hide", "off", "remove", "turn off", "disable"])
     wants_show = any(w in text for w in ["show", "on", "display", "enable", "where", "see"]) or not wants_hide
 
     # Dynamic layer mentions based on registry
-    registry = get_layer_registry()
-    for layer_key, meta in registry.items():
-        syns: List[str] = [layer_key] + list(meta.get("synonyms") or [])
+    for layer_key, syns in _SYNS.items():
         if any(s in text for s in syns):
             intents.append({"type": "hide_layer" if wants_hide else "show_layer", "layer": layer_key})
 
     return intents
 
 
+def _azure_configured() -> bool:
+    """True when the Azure OpenAI endpoint, key and deployment are all set."""
+    return bool(
+        os.environ.get("AZURE_OPENAI_ENDPOINT")
+        and os.environ.get("AZURE_OPENAI_API_KEY")
+        and os.environ.get("AZURE_OPENAI_DEPLOYMENT")
+    )
+
+
+def _azure_chat_completion(payload: dict, timeout: int) -> dict:
+    """POST a chat/completions payload to the configured Azure deployment over the pooled session.
+    Callers must check _azure_configured() first; raises on transport or HTTP errors.
+    """
+    endpoint = os.environ["AZURE_OPENAI_ENDPOINT"]
+    deployment = os.environ["AZURE_OPENAI_DEPLOYMENT"]
+    api_version = os.environ.get("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
+    url = f"{endpoint.rstrip('/')}/openai/deployments/{deployment}/chat/completions?api-version={api_version}"
+    headers = {
+        "Content-Type": "application/json",
+        "api-key": os.environ["AZURE_OPENAI_API_KEY"],
+    }
+    resp = _azure.post(url, headers=headers, data=orjson.dumps(payload), timeout=timeout)
+    resp.raise_for_status()
+    return orjson.loads(resp.content)
+
+
 def _azure_openai_reply(user_message: str) -> Optional[str]:
     """Optional: Use Azure OpenAI to craft a friendly reply. Returns None on any issue."""
-    endpoint = os.environ.get("AZURE_OPENAI_ENDPOINT")
-    api_key = os.environ.get("AZURE_OPENAI_API_KEY")
-    deployment = os.environ.get("AZURE_OPENAI_DEPLOYMENT")
-    api_version = os.environ.get("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
-    if not (endpoint and api_key and deployment):
+    if not _azure_configured():
         return None
     try:
-        url = f"{endpoint.rstrip('/')}/openai/deployments/{deployment}/chat/completions?api-version={api_version}"
-        headers = {
-            "Content-Type": "application/json",
-            "api-key": api_key,
-        }
         payload = {
             "messages": [
                 {"role": "user", "content": user_message},
@@ -302,9 +534,7 @@ def _azure_openai_reply(user_message: str) -> Optional[str]:
             "temperature": 0.2,
             "top_p": 0.9,
         }
-        resp = requests.post(url, headers=headers, json=payload, timeout=15)
-        resp.raise_for_status()
-        data = resp.json()
+        data = _azure_chat_completion(payload, timeout=15)
         choices = data.get("choices") or []
         if choices and choices[0].get("message", {}).get("content"):
             return choices[0]["message"]["content"].strip()
@@ -313,69 +543,103 @@ def _azure_openai_reply(user_message: str) -> Optional[str]:
     return None
 
 
+# Tool schemas are built once from the registered layers
+_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "show_layer",
+            "description": "Show a specific map layer to the user. Use fit=true to fit map to that layer.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "layer": {"type": "string", "enum": list(_LAYER_REGISTRY)},
+                    "fit": {"type": "boolean", "description": "Whether to fit/zoom to the layer after showing."}
+                },
+                "required": ["layer"],
+                "additionalProperties": False
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "hide_layer",
+            "description": "Hide a specific map layer from the user interface.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "layer": {"type": "string", "enum": list(_LAYER_REGISTRY)}
+                },
+                "required": ["layer"],
+                "additionalProperties": False
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "clear_all",
+            "description": "Clear or remove all overlays from the map.",
+            "parameters": {"type": "object", "properties": {}, "additionalProperties": False}
+        }
+    }
+]
+
+
+def _handle_show_layer(args: dict) -> Optional[dict]:
+    layer = args.get("layer")
+    if not isinstance(layer, str) or layer not in _LAYER_NAMES:
+        return None
+    intent = {"type": "show_layer", "layer": layer}
+    if isinstance(args.get("fit"), bool):
+        intent["fit"] = args.get("fit")
+    return intent
+
+
+def _handle_hide_layer(args: dict) -> Optional[dict]:
+    layer = args.get("layer")
+    if not isinstance(layer, str) or layer not in _LAYER_NAMES:
+        return None
+    return {"type": "hide_layer", "layer": layer}
+
+
+def _handle_clear_all(args: dict) -> Optional[dict]:
+    return {"type": "clear_all"}
+
+
+_TOOL_HANDLERS: Dict[str, Callable[[dict], Optional[dict]]] = {
+    "show_layer": _handle_show_layer,
+    "hide_layer": _handle_hide_layer,
+    "clear_all": _handle_clear_all,
+}
+
+
+def _tool_call_intent(fn: dict) -> Optional[dict]:
+    """Map one tool/function call ({name, arguments}) to a map intent, or None if unknown/invalid."""
+    handler = _TOOL_HANDLERS.get(fn.get("name"))
+    if handler is None:
+        return None
+    try:
+        args = orjson.loads(fn.get("arguments") or "{}")
+    except Exception:
+        args = {}
+    return handler(args if isinstance(args, dict) else {})
+
+
 def _azure_openai_chat_with_tools(user_message: str) -> Optional[dict]:
     """Use Azure OpenAI tool calling to both answer briefly and emit map intents.
     Returns dict with keys: reply (str or None), intents (list) or None on error/unavailable.
     """
-    endpoint = os.environ.get("AZURE_OPENAI_ENDPOINT")
-    api_key = os.environ.get("AZURE_OPENAI_API_KEY")
-    deployment = os.environ.get("AZURE_OPENAI_DEPLOYMENT")
-    api_version = os.environ.get("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
-    if not (endpoint and api_key and deployment):
+    if not _azure_configured():
         return None
 
-    # Build tool schemas dynamically from registered layers
-    layer_names = list(get_layer_registry().keys())
-    tools = [
-        {
-            "type": "function",
-            "function": {
-                "name": "show_layer",
-                "description": "Show a specific map layer to the user. Use fit=true to fit map to that layer.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "layer": {"type": "string", "enum": layer_names},
-                        "fit": {"type": "boolean", "description": "Whether to fit/zoom to the layer after showing."}
-                    },
-                    "required": ["layer"],
-                    "additionalProperties": False
-                }
-            }
-        },
-        {
-            "type": "function",
-            "function": {
-                "name": "hide_layer",
-                "description": "Hide a specific map layer from the user interface.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "layer": {"type": "string", "enum": layer_names}
-                    },
-                    "required": ["layer"],
-                    "additionalProperties": False
-                }
-            }
-        },
-        {
-            "type": "function",
-            "function": {
-                "name": "clear_all",
-                "description": "Clear or remove all overlays from the map.",
-                "parameters": {"type": "object", "properties": {}, "additionalProperties": False}
-            }
-        }
-    ]
-
     try:
-        url = f"{endpoint.rstrip('/')}/openai/deployments/{deployment}/chat/completions?api-version={api_version}"
-        headers = {"Content-Type": "application/json", "api-key": api_key}
         payload = {
             "messages": [
                 {"role": "user", "content": user_message},
             ],
-            "tools": tools,
+            "tools": _TOOLS,
             "tool_choice": "auto",
             "temperature": 0.2,
             "top_p": 0.9,
@@ -398,9 +662,7 @@ def _azure_openai_chat_with_tools(user_message: str) -> Optional[dict]:
                     },
                 }
             ]
-        resp = requests.post(url, headers=headers, json=payload, timeout=20)
-        resp.raise_for_status()
-        data = resp.json()
+        data = _azure_chat_completion(payload, timeout=20)
         choices = data.get("choices") or []
         if not choices:
             return {"reply": None, "intents": []}
@@ -411,79 +673,111 @@ def _azure_openai_chat_with_tools(user_message: str) -> Optional[dict]:
         # Azure returns tool calls under message.tool_calls for the 2024 API
         tool_calls = message.get("tool_calls") or []
         for call in tool_calls:
-            fn = (call.get("function") or {})
-            name = fn.get("name")
-            args_str = fn.get("arguments") or "{}"
-            try:
-                args = json.loads(args_str)
-            except Exception:
-                args = {}
-            if name == "show_layer":
-                layer = args.get("layer")
-                if layer in layer_names:
-                    intent = {"type": "show_layer", "layer": layer}
-                    if isinstance(args.get("fit"), bool):
-                        intent["fit"] = args.get("fit")
-                    intents.append(intent)
-            elif name == "hide_layer":
-                layer = args.get("layer")
-                if layer in layer_names:
-                    intents.append({"type": "hide_layer", "layer": layer})
-            elif name == "clear_all":
-                intents.append({"type": "clear_all"})
+            intent = _tool_call_intent(call.get("function") or {})
+            if intent:
+                intents.append(intent)
 
         # Back-compat: some models may use function_call instead of tool_calls
         if not intents and message.get("function_call"):
-            fn = message.get("function_call")
-            name = fn.get("name")
-            try:
-                args = json.loads(fn.get("arguments") or "{}")
-            except Exception:
-                args = {}
-            if name == "show_layer" and args.get("layer") in layer_names:
-                intents.append({"type": "show_layer", "layer": args.get("layer")})
-            elif name == "hide_layer" and args.get("layer") in layer_names:
-                intents.append({"type": "hide_layer", "layer": args.get("layer")})
-            elif name == "clear_all":
-                intents.append({"type": "clear_all"})
+            intent = _tool_call_intent(message.get("function_call"))
+            if intent:
+                intents.append(intent)
 
         return {"reply": reply_text, "intents": intents}
     except Exception:
         return None
 
+
+def _detect_layers(text: str) -> List[str]:
+    """Layer keys whose synonyms appear in text; all layers when none match."""
+    keys = [k for k, syns in _SYNS.items() if any(s in text for s in syns)]
+    return keys or list(_LAYER_REGISTRY.keys())
+
+
+def _compose_deterministic_reply(low: str, registry: Dict[str, Dict[str, object]]) -> Optional[str]:
+    """Rule-based list/summary answer built from layer contexts, or None if the message asks for neither."""
+    targets = _detect_layers(low)
+    # List flow
+    if _LIST_RE.search(low):
+        bucket: List[str] = []
+        for key in targets:
+            meta = registry.get(key) or {}
+            builder: Callable[..., str] = meta.get("context_builder")  # type: ignore
+            if not callable(builder):
+                continue
+            try:
+                ctx = builder(300)
+                lines = [ln for ln in ctx.splitlines() if ln.startswith("- ")]
+                if lines:
+                    title = str(meta.get("title") or key.title())
+                    bucket.append(f"{title}:\n" + "\n".join(lines[:100]))
+            except Exception:
+                continue
+        if bucket:
+            return "\n\n".join(bucket)
+    # Summarize flow
+    if _SUMMARY_RE.search(low):
+        pieces: List[str] = []
+        for key in targets:
+            meta = registry.get(key) or {}
+            builder: Callable[..., str] = meta.get("context_builder")  # type: ignore
+            total_re = meta.get("total_re")
+            if not callable(builder):
+                continue
+            try:
+                ctx = builder(50)
+                total = 0
+                if total_re is not None:
+                    m = total_re.search(ctx)
+                    if m:
+                        total = int(m.group(1))
+                examples = [ln[2:] for ln in ctx.splitlines() if ln.startswith("- ")][:5]
+                title = str(meta.get("title") or key.title())
+                if total:
+                    pieces.append(f"{title}: {total} items." + (f" Examples: {', '.join(examples)}." if examples else ""))
+            except Exception:
+                continue
+        if pieces:
+            return " ".join(pieces)
+    return None
+
+
 @app.route('/api/chat', methods=['POST'])
 def chat_api():
     data = request.get_json(silent=True) or {}
     message = data.get('message', '')
     if not message:
-        return jsonify({"reply": "Please type a question.", "intents": []})
+        return _ojson({"reply": "Please type a question.", "intents": []})
+    if _GREETING_RE.match(message):
+        return _ojson({"reply": "Hi! Ask about dengue hotspots or planning areas.", "intents": []})
+    if _CLEAR_ONLY_RE.match(message):
+        return _ojson({"reply": "Clearing map overlays.", "intents": [{"type": "clear_all"}]})
 
-    # Build dynamic dengue context and prepend to the conversation to ground the model
-    try:
-        registry = get_layer_registry()
-        context_sections: List[str] = []
-        for key, meta in registry.items():
-            builder: Callable[..., str] = meta.get("context_builder")  # type: ignore
-            if callable(builder):
-                try:
-                    # Use larger max for planning-like lists; default to 100
-                    ctx = builder(100)
-                    context_sections.append(ctx)
-                except Exception:
-                    continue
-        context_blob = (
-            "Context from live API data (use for answers):\n"
-            + "\n\n".join(context_sections)
-            + "\n\nInstructions: Answer strictly using the context lists above for available layers. "
-              "When asked to list items, provide a concise bullet or numbered list from the context. "
-              "If a layer has no context, say that data is currently unavailable. Keep answers short."
-        )
-        enriched_message = f"{context_blob}\n\nUser: {message}"
-    except Exception:
-        enriched_message = message
+    registry = get_layer_registry()
+    low = message.lower()
+    azure_ready = _azure_configured()
+
+    # Build dynamic layer context and prepend to the conversation to ground the model.
+    # Only the Azure paths consume it, so skip the upstream fetches when Azure is not configured.
+    enriched_message = message
+    if azure_ready:
+        try:
+            # Only ground on layers the user mentioned (all layers when none are named).
+            mentioned = {k: registry[k] for k in _detect_layers(low) if k in registry}
+            context_sections = _chat_contexts(mentioned).values()
+            context_blob = (
+                "Context from live API data (use for answers):\n"
+                + "\n\n".join(context_sections)
+                + "\n\nInstructions: Answer strictly using the context lists above for available layers. "
+                  "When asked to list items, provide a concise bullet or numbered list from the context. "
+                  "If a layer has no context, say that data is currently unavailable. Keep answers short."
+            )
+            enriched_message = f"{context_blob}\n\nUser: {message}"
+        except Exception:
+            pass
 
     # Prefer tool-calling path when Azure is configured
-    tool_out = _azure_openai_chat_with_tools(enriched_message)
+    tool_out = _azure_openai_chat_with_tools(enriched_message) if azure_ready else None
     if tool_out is not None:
         intents = tool_out.get("intents") or []
         reply = tool_out.get("reply")
@@ -492,125 +786,15 @@ def chat_api():
             intents = _classify_intents(message)
         # Prefer Azure model reply; if missing (e.g., only tool calls), try a second Azure reply
         if not reply:
-            second = _azure_openai_reply(enriched_message)
-            if second:
-                reply = second
+            reply = _azure_openai_reply(enriched_message)
         # Deterministic fallbacks for common queries when model reply is still missing
         if not reply:
-            low = message.lower()
-            # Try to detect a target layer dynamically
-            def _detect_layers(txt: str) -> List[str]:
-                keys: List[str] = []
-                reg = get_layer_registry()
-                for k, meta in reg.items():
-                    syns = [k] + list(meta.get("synonyms") or [])
-                    if any(s in txt for s in syns):
-                        keys.append(k)
-                return keys or list(get_layer_registry().keys())  # fallback to all
-
-            registry = get_layer_registry()
-            target_layers = _detect_layers(low)
-            # List flow
-            if re.search(r"\b(list|show)\b", low):
-                bucket: List[str] = []
-                for key in target_layers:
-                    meta = registry.get(key) or {}
-                    builder: Callable[..., str] = meta.get("context_builder")  # type: ignore
-                    if not callable(builder):
-                        continue
-                    try:
-                        ctx = builder(300)
-                        lines = [ln for ln in ctx.splitlines() if ln.startswith("- ")]
-                        if lines:
-                            title = str(meta.get("title") or key.title())
-                            bucket.append(f"{title}:\n" + "\n".join(lines[:100]))
-                    except Exception:
-                        continue
-                if bucket:
-                    reply = "\n\n".join(bucket)
-            # Summarize flow
-            if not reply and re.search(r"\b(summarize|summary)\b", low):
-                pieces: List[str] = []
-                for key in target_layers:
-                    meta = registry.get(key) or {}
-                    builder: Callable[..., str] = meta.get("context_builder")  # type: ignore
-                    total_rx = meta.get("total_regex")
-                    if not callable(builder):
-                        continue
-                    try:
-                        ctx = builder(50)
-                        total = 0
-                        if isinstance(total_rx, str):
-                            m = re.search(total_rx, ctx)
-                            if m:
-                                total = int(m.group(1))
-                        examples = [ln[2:] for ln in ctx.splitlines() if ln.startswith("- ")][:5]
-                        title = str(meta.get("title") or key.title())
-                        if total:
-                            line = f"{title}: {total} items." + (f" Examples: {', '.join(examples)}." if examples else "")
-                            pieces.append(line)
-                    except Exception:
-                        continue
-                if pieces:
-                    reply = " ".join(pieces)
-        # Final minimal fallback
-        if not reply:
-            reply = ""
-        return jsonify({"reply": reply, "intents": intents})
+            reply = _compose_deterministic_reply(low, registry)
+        return _ojson({"reply": reply or "", "intents": intents})
 
     # Fallback path: rule-based intents + deterministic summaries/lists + optional Azure reply (grounded)
     intents = _classify_intents(message)
-    reply = None
-
-    # Deterministic answers for common queries (registry-based)
-    low = message.lower()
-    try:
-        registry = get_layer_registry()
-        def _detect_layers(txt: str) -> List[str]:
-            keys: List[str] = []
-            for k, meta in registry.items():
-                syns = [k] + list(meta.get("synonyms") or [])
-                if any(s in txt for s in syns):
-                    keys.append(k)
-            return keys or list(registry.keys())
-
-        targets = _detect_layers(low)
-        if re.search(r"\b(list|show)\b", low):
-            bucket: List[str] = []
-            for key in targets:
-                meta = registry.get(key) or {}
-                builder: Callable[..., str] = meta.get("context_builder")  # type: ignore
-                if not callable(builder):
-                    continue
-                ctx = builder(300)
-                lines = [ln for ln in ctx.splitlines() if ln.startswith("- ")]
-                if lines:
-                    title = str(meta.get("title") or key.title())
-                    bucket.append(f"{title}:\n" + "\n".join(lines[:100]))
-            if bucket:
-                reply = "\n\n".join(bucket)
-        elif re.search(r"\b(summarize|summary)\b", low):
-            pieces: List[str] = []
-            for key in targets:
-                meta = registry.get(key) or {}
-                builder: Callable[..., str] = meta.get("context_builder")  # type: ignore
-                total_rx = meta.get("total_regex")
-                if not callable(builder):
-                    continue
-                ctx = builder(50)
-                total = 0
-                if isinstance(total_rx, str):
-                    m = re.search(total_rx, ctx)
-                    if m:
-                        total = int(m.group(1))
-                examples = [ln[2:] for ln in ctx.splitlines() if ln.startswith("- ")][:5]
-                title = str(meta.get("title") or key.title())
-                if total:
-                    pieces.append(f"{title}: {total} items." + (f" Examples: {', '.join(examples)}." if examples else ""))
-            if pieces:
-                reply = " ".join(pieces)
-    except Exception:
-        pass
+    reply = _compose_deterministic_reply(low, registry)
 
     # If still no reply, compose simple action phrases from intents
     if not reply and intents:
@@ -629,23 +813,19 @@ def chat_api():
         if phrases:
             reply = " ".join(phrases)
 
-    # Try Azure reply grounded in context; only override if no reply yet
-    azure_reply = _azure_openai_reply(enriched_message)
-    if azure_reply and not reply:
-        reply = azure_reply
+    # Try Azure reply grounded in context; only when nothing deterministic matched
+    if not reply and azure_ready:
+        reply = _azure_openai_reply(enriched_message)
 
     if not reply:
         reply = "Here to help with dengue hotspots and planning areas."
-    return jsonify({"reply": reply, "intents": intents})
+    return _ojson({"reply": reply, "intents": intents})
 
 
 @app.route('/api/azure-health')
 def azure_health():
     """Runtime health check for Azure OpenAI integration."""
-    endpoint = os.environ.get("AZURE_OPENAI_ENDPOINT")
-    api_key = os.environ.get("AZURE_OPENAI_API_KEY")
-    deployment = os.environ.get("AZURE_OPENAI_DEPLOYMENT")
-    configured = bool(endpoint and api_key and deployment)
+    configured = _azure_configured()
 
     tool_calling_ok = False
     tool_detail = ""
@@ -672,7 +852,7 @@ def azure_health():
     else:
         tool_detail = basic_detail = "Missing AZURE_OPENAI_* env vars"
 
-    return jsonify({
+    return _ojson({
         "configured": configured,
         "tool_calling_ok": tool_calling_ok,
         "tool_detail": tool_detail,
@@ -684,20 +864,13 @@ def azure_health():
 @app.route('/api/welcome')
 def welcome_message():
     """Return a dynamic welcome generated by Azure OpenAI using live dengue + planning data."""
+    registry = get_layer_registry()
     try:
-        registry = get_layer_registry()
-        contexts = []
-        for key, meta in registry.items():
-            builder: Callable[..., str] = meta.get("context_builder")  # type: ignore
-            if callable(builder):
-                try:
-                    # Slightly smaller per-layer for the welcome
-                    contexts.append(builder(60))
-                except Exception:
-                    continue
-        ctx = "\n\n".join(contexts)
+        # Slightly smaller per-layer for the welcome; all layers are fetched concurrently
+        contexts = _build_layer_contexts(registry, 60)
     except Exception:
-        ctx = ""
+        contexts = {}
+    ctx = "\n\n".join(contexts.values())
     prompt = (
         "Using the live context below about Singapore dengue clusters and planning areas, write a brief 1-2 sentence welcome. "
         "Summarize the current hotspot situation and invite the user to toggle layers or ask questions.\n\n"
@@ -705,23 +878,19 @@ def welcome_message():
     ).strip()
     reply = _azure_openai_reply(prompt)
     if not reply:
-        # Dynamic non-static fallback from all registered layer counts (no LLM)
-        registry = get_layer_registry()
+        # Dynamic non-static fallback from all registered layer counts (no LLM).
+        # Totals sit on the first context line, so reuse the contexts fetched above.
         bits: List[str] = []
-        for key, meta in registry.items():
-            builder: Callable[..., str] = meta.get("context_builder")  # type: ignore
-            total_rx = meta.get("total_regex")
-            if not callable(builder) or not isinstance(total_rx, str):
-                continue
-            try:
-                c = builder(30)
-                m = re.search(total_rx, c)
-                if m:
-                    total = int(m.group(1))
-                    title = str(meta.get("title") or key.title())
-                    bits.append(f"{total} {title.lower()}")
-            except Exception:
+        for key, c in contexts.items():
+            meta = registry.get(key) or {}
+            total_re = meta.get("total_re")
+            if total_re is None:
                 continue
+            m = total_re.search(c)
+            if m:
+                total = int(m.group(1))
+                title = str(meta.get("title") or key.title())
+                bits.append(f"{total} {title.lower()}")
         intro = (
             "Welcome. Explore the map to see available layers, "
             "and ask the assistant for quick summaries or lists."
@@ -730,7 +899,11 @@ def welcome_message():
             reply = f"{intro} For context, currently tracked: " + ", ".join(bits) + "."
         else:
             reply = intro
-    return jsonify({"reply": reply})
+    return _ojson({"reply": reply})
+
+# Start after every helper is defined so the first refresh cannot race module import
+if os.environ.get("CONTEXT_REFRESH_ENABLED", "").lower() in ("1", "true", "yes"):
+    threading.Thread(target=_refresh_contexts_loop, name="context-refresh", daemon=True).start()
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -1,63 +1,221 @@
 import os
+import re
 import json
+import stat
 import sys
-import getpass
-import requests
+import time
+import base64
 from pathlib import Path
 
+try:
+    import orjson
+    _loads = orjson.loads
+
+    def _dumps_pretty(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+except ImportError:
+    _loads = json.loads
+
+    def _dumps_pretty(obj):
+        return json.dumps(obj, indent=2)
+
 AUTH_URL = "https://www.onemap.gov.sg/api/auth/post/getToken"
+SEARCH_URL = "https://www.onemap.gov.sg/api/common/elastic/search"
 ENV_PATH = Path(__file__).parent / ".env"
+# Skip re-authenticating while the stored token has at least this much lifetime left
+MIN_TOKEN_LIFETIME = 6 * 3600
+_TOKEN_RE = re.compile(rb'"(?:access_token|accessToken|token)"\s*:\s*"([^"\\]+)"')
+# KEY=VALUE per line, optionally prefixed with `export`; comment and blank lines never match.
+# [ \t] rather than \s so an empty value cannot swallow the next line.
+_ENV_RE = re.compile(r"(?m)^[ \t]*(?:export[ \t]+)?([^\s=#]+)[ \t]*=[ \t]*(.*?)[ \t]*\r?$")
+
+# Pooled keep-alive session, created on first network use (see _get_session)
+SESSION = None
+
+def _get_session():
+    """Build the pooled session lazily so the cached-token path never imports requests."""
+    global SESSION
+    if SESSION is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        SESSION = requests.Session()
+        # The login POST is safe to retry on transient 5xx
+        SESSION.mount("https://", HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=4,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.3,
+                status_forcelist=[500, 502, 503, 504],
+                allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"},
+            ),
+        ))
+    return SESSION
+
+def _decode_jwt_exp(token):
+    """Return the `exp` claim (epoch seconds) of a JWT, or None if it cannot be read."""
+    try:
+        seg = token.split(".")[1]
+        payload = _loads(base64.urlsafe_b64decode(seg + "=" * (-len(seg) % 4)))
+        return float(payload["exp"])
+    except Exception:
+        return None
+
+def _parse_env(text):
+    """Parse KEY=VALUE lines of .env text into a dict, skipping blanks and comments."""
+    return dict(_ENV_RE.findall(text))
+
+# ((st_mtime_ns, st_size), mode, raw text, parsed) of the last .env read, reused while unchanged
+_ENV_CACHE = None
+
+def _read_env():
+    """(raw text, parsed dict, file mode) of .env, re-reading only when the file's stat changes.
+
+    A missing .env reads as ("", {}, 0o600). The dict is a fresh copy each call.
+    """
+    global _ENV_CACHE
+    try:
+        st = os.stat(ENV_PATH)
+    except FileNotFoundError:
+        return "", {}, 0o600
+    stamp = (st.st_mtime_ns, st.st_size)
+    if _ENV_CACHE is None or _ENV_CACHE[0] != stamp:
+        text = ENV_PATH.read_bytes().decode()
+        _ENV_CACHE = (stamp, stat.S_IMODE(st.st_mode), text, _parse_env(text))
+    _, mode, text, parsed = _ENV_CACHE
+    # Never hand out the cached dict itself
+    return text, dict(parsed), mode
+
+def _update_env_text(text, updates):
+    """Set (or, for None, drop) the given keys in raw .env text, leaving every other line as is."""
+    for key, value in updates.items():
+        line_re = re.compile(rf"(?m)^[ \t]*(?:export[ \t]+)?{re.escape(key)}[ \t]*=.*(?:\n|$)")
+        new_line = "" if value is None else f"{key}={value}\n"
+        # Rewrite the first occurrence in place and drop any duplicates after it
+        seen = []
+
+        def _replace(m, seen=seen, new_line=new_line):
+            if seen:
+                return ""
+            seen.append(m)
+            return new_line
+
+        text = line_re.sub(_replace, text)
+        if not seen and new_line:
+            if text and not text.endswith("\n"):
+                text += "\n"
+            text += new_line
+    return text
+
+def _write_env_atomic(data, mode):
+    """Replace .env with data via a temp file created with the given file mode."""
+    tmp = ENV_PATH.with_name(ENV_PATH.name + ".tmp")
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        # os.open's mode is filtered by the umask, and a stale tmp keeps its old mode
+        os.chmod(tmp, mode)
+        os.replace(tmp, ENV_PATH)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+def fetch_token_and_warm(email, password):
+    """Fetch a token and verify it with a minimal search over the same keep-alive connection.
+
+    Returns (token, verified, auth_data); auth_data is only decoded when the token is not found
+    by the fast byte scan, and token is None if the response carried none.
+    Raises requests.RequestException if the auth call itself fails.
+    """
+    import requests
+
+    session = _get_session()
+    resp = session.post(AUTH_URL, json={"email": email, "password": password}, timeout=15)
+    resp.raise_for_status()
+    data = None
+    m = _TOKEN_RE.search(resp.content)
+    if m:
+        token = m.group(1).decode()
+    else:
+        data = _loads(resp.content)
+        token = data.get("access_token") or data.get("accessToken") or data.get("token")
+    verified = False
+    if token:
+        try:
+            check = session.get(
+                SEARCH_URL,
+                params={"searchVal": "Orchard", "returnGeom": "N", "getAddrDetails": "N", "pageNum": 1},
+                headers={"Authorization": token},
+                timeout=10,
+            )
+            verified = check.ok
+        except requests.RequestException:
+            pass
+    return token, verified, data
 
 def main():
     print("OneMap token fetcher (writes ONEMAP_TOKEN to .env)")
+    force = "--force" in sys.argv[1:]
+
+    # Read .env once; reused for the expiry check, credential fallback and the write-back
+    env_text, env_vals, env_mode = _read_env()
+
+    if not force:
+        stored = env_vals.get("ONEMAP_TOKEN")
+        exp = _decode_jwt_exp(stored) if stored else None
+        if exp is not None and exp - time.time() > MIN_TOKEN_LIFETIME:
+            hours = (exp - time.time()) / 3600
+            print(f"Existing ONEMAP_TOKEN still valid for {hours:.1f}h; skipping (use --force to refresh)")
+            return
 
     # Prefer non-interactive credentials from env or .env
     email = os.getenv("ONEMAP_LOGIN_EMAIL")
     password = os.getenv("ONEMAP_LOGIN_PW")
 
-    if (not email or not password) and ENV_PATH.exists():
-        # Try to read from local .env if not already in process env
-        env_vals = {}
-        for line in ENV_PATH.read_text().splitlines():
-            if not line.strip() or line.strip().startswith("#"):
-                continue
-            if "=" in line:
-                k, v = line.split("=", 1)
-                env_vals[k.strip()] = v.strip()
-        email = email or env_vals.get("ONEMAP_LOGIN_EMAIL")
-        password = password or env_vals.get("ONEMAP_LOGIN_PW")
+    # Fall back to local .env if not already in process env
+    email = email or env_vals.get("ONEMAP_LOGIN_EMAIL")
+    password = password or env_vals.get("ONEMAP_LOGIN_PW")
 
     # Final fallback to prompt if still missing
     if not email:
         email = input("Email: ").strip()
     if not password:
+        import getpass
         password = getpass.getpass("Password: ")
 
+    # Only needed once we know a network round-trip is required
+    import requests
+
     try:
-        resp = requests.post(AUTH_URL, json={"email": email, "password": password}, timeout=15)
-        resp.raise_for_status()
+        token, verified, data = fetch_token_and_warm(email, password)
     except requests.RequestException as e:
         print(f"Request failed: {e}")
         sys.exit(1)
 
-    data = resp.json()
-    token = data.get("access_token") or data.get("accessToken") or data.get("token")
     if not token:
         print("No token found in response:")
-        print(json.dumps(data, indent=2))
+        print(_dumps_pretty(data))
         sys.exit(1)
 
-    # Write/update .env
-    existing = {}
-    if ENV_PATH.exists():
-        for line in ENV_PATH.read_text().splitlines():
-            if not line.strip() or line.strip().startswith("#"):
-                continue
-            if "=" in line:
-                k, v = line.split("=", 1)
-                existing[k.strip()] = v.strip()
-    existing["ONEMAP_TOKEN"] = token
-    ENV_PATH.write_text("\n".join([f"{k}={v}" for k, v in existing.items()]) + "\n")
+    # Nothing to persist if the server handed back the token we already store
+    if env_vals.get("ONEMAP_TOKEN") == token and verified == ("ONEMAP_TOKEN_VERIFIED_AT" in env_vals):
+        print("Token unchanged; .env not rewritten")
+        return
+
+    # Write/update .env, touching only the token lines so comments and other entries survive
+    updates = {"ONEMAP_TOKEN": token, "ONEMAP_TOKEN_VERIFIED_AT": None}
+    if verified:
+        updates["ONEMAP_TOKEN_VERIFIED_AT"] = str(int(time.time()))
+    else:
+        print("Warning: token was issued but a test search with it did not succeed")
+    # Write to a sibling temp file and swap it in, so a crash never leaves a truncated .env
+    _write_env_atomic(_update_env_text(env_text, updates).encode(), env_mode)
 
     print(f"Wrote ONEMAP_TOKEN to {ENV_PATH}")
 
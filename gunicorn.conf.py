@@ -0,0 +1,9 @@
+import os
+
+# Every request handler blocks on upstream HTTP (OneMap, Azure OpenAI), so use
+# cooperative gevent workers instead of the default sync worker.
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+worker_class = "gevent"
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+worker_connections = 1000
+timeout = 60